@@ -16,39 +16,393 @@ import signal
 import socket
 import asyncio
 import struct
+import errno
 import argparse
 import uuid
 import time
 import random
 import logging
-import platform
 import ctypes.util
 import collections
-import xml.etree.ElementTree as ElementTree
+import functools
 import http
 import http.server
-import urllib.request
+import urllib.error
 import urllib.parse
+import xml.sax.saxutils
 import os
-import pwd
-import grp
 import datetime
+# preloaded for socket.gethostbyaddr(), it cannot be imported after chroot'ing
+import encodings.idna  # noqa: F401
 
-# try to load more secure XML module first, fallback to default if not present
+# try to load the libxml2-based lxml module first as it is much faster, the
+# parser is configured to not resolve entities or access the network
 try:
-    from defusedxml.ElementTree import fromstring as ETfromString
+    from lxml import etree as ElementTree
+    ETfromString = functools.partial(ElementTree.fromstring, parser=ElementTree.XMLParser(
+        resolve_entities=False, no_network=True, huge_tree=False))
+    XML_USE_LXML = True
 except ModuleNotFoundError:
-    from xml.etree.ElementTree import fromstring as ETfromString
+    import xml.etree.ElementTree as ElementTree
+    XML_USE_LXML = False
+
+    # try to load more secure XML module first, fallback to default if not present
+    try:
+        from defusedxml.ElementTree import fromstring as ETfromString
+    except ModuleNotFoundError:
+        from xml.etree.ElementTree import fromstring as ETfromString
+
+# use the faster event loop implementation of uvloop if present
+try:
+    import uvloop
+except ModuleNotFoundError:
+    uvloop = None
+
+# use aiohttp for fetching metadata if present, plain asyncio streams otherwise
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    aiohttp = None
 
 
 WSDD_VERSION = '0.6.4'
 
+# name of the operating system without version, e.g. 'linux' or 'freebsd'
+PLATFORM = sys.platform.rstrip('0123456789')
+# Android reports its own platform but runs a Linux kernel
+LINUX = PLATFORM in ('linux', 'android')
+
+
+# data structures for sendmmsg(2)/recvmmsg(2) as defined in Linux' socket.h
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+# sendmmsg/recvmmsg are not provided by the socket module, so get them from
+# libc directly
+libc_sendmmsg = None
+libc_recvmmsg = None
+if LINUX:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc_sendmmsg = getattr(libc, 'sendmmsg', None)
+    libc_recvmmsg = getattr(libc, 'recvmmsg', None)
+
+# number of datagrams to be received with a single recvmmsg call
+RECV_BATCH_SIZE = 16
+SOCKADDR_STORAGE_LEN = 128
+
+# Linux' socket options that are not provided by the socket module (on all
+# versions). With pktinfo, the arriving interface and the destination
+# address of datagrams are passed as ancillary data, which allows to receive
+# multicast traffic on all interfaces with a single socket.
+IP_MULTICAST_ALL = 49
+IPV6_MULTICAST_ALL = 29
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8)
+PKTINFO_CONTROL_LEN = socket.CMSG_SPACE(20)  # sizeof(struct in6_pktinfo)
+MULTICAST_RECEIVER = LINUX
+
+# receive buffer size for multicast sockets, the default buffer overflows
+# when lots of hosts announce themselves at once. Linux caps the size, but
+# other systems (e.g. FreeBSD with kern.ipc.maxsockbuf) reject a too large
+# one, so smaller sizes down to the minimum are tried then.
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+MIN_RECV_BUFFER_SIZE = 256 * 1024
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+BUSY_POLL_USECS = 50
+
+
+def pack_sockaddr(family, addr):
+    """
+    Convert an address tuple as used by the socket module into a Linux
+    sockaddr_in or sockaddr_in6 structure.
+    """
+    if family == socket.AF_INET:
+        return (struct.pack('=H', family) + struct.pack('!H', addr[1]) + socket.inet_pton(family, addr[0])
+                + bytes(8))
+
+    # the scope is given by the scope ID, strip it from the address string
+    return (struct.pack('=H', family) + struct.pack('!HI', addr[1], addr[2])
+            + socket.inet_pton(family, addr[0].partition('%')[0]) + struct.pack('=I', addr[3]))
+
+
+def unpack_sockaddr(buf):
+    """
+    Convert a Linux sockaddr_in or sockaddr_in6 structure into an address
+    tuple as returned by the socket module.
+    """
+    family, = struct.unpack_from('=H', buf)
+    if family == socket.AF_INET:
+        port, = struct.unpack_from('!H', buf, 2)
+        return (socket.inet_ntop(family, buf[4:8]), port)
+
+    port, flowinfo = struct.unpack_from('!HI', buf, 2)
+    scope_id, = struct.unpack_from('=I', buf, 24)
+    # let getnameinfo add the scope to the address string like recvfrom does
+    host, _ = socket.getnameinfo((socket.inet_ntop(family, buf[8:24]), port, flowinfo, scope_id),
+                                 socket.NI_NUMERICHOST | socket.NI_NUMERICSERV)
+    return (host, port, flowinfo, scope_id)
+
+
+def tune_recv_socket(s):
+    """enlarge the receive buffer of a socket and enable busy polling on Linux"""
+    size = RECV_BUFFER_SIZE
+    while True:
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+            break
+        except OSError as e:
+            size //= 2
+            if size < MIN_RECV_BUFFER_SIZE:
+                logger.debug('cannot enlarge receive buffer: {}'.format(e))
+                break
+
+    if LINUX:
+        try:
+            s.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_USECS)
+        except OSError as e:
+            logger.debug('cannot enable busy polling: {}'.format(e))
+
+
+def unpack_ancillary(buf):
+    """
+    Convert a buffer of control messages into a list of (level, type, data)
+    tuples as returned by socket.recvmsg.
+    """
+    ancdata = []
+    offset = 0
+    header_len = socket.CMSG_LEN(0)
+    while offset + header_len <= len(buf):
+        length, level, cmsg_type = struct.unpack_from('@Nii', buf, offset)
+        if length < header_len:
+            break
+        ancdata.append((level, cmsg_type, buf[offset + header_len:offset + length]))
+        offset += align_to(length, ctypes.sizeof(ctypes.c_size_t))
+
+    return ancdata
+
+
+class RecvBatch:
+    """
+    Buffers for receiving multiple datagrams, optionally with ancillary
+    data, at once using recvmmsg. Falls back to receiving datagrams one by
+    one into a single buffer if recvmmsg is not available.
+    """
+
+    def __init__(self, control_len=0):
+        self.control_len = control_len
+        if libc_recvmmsg is None:
+            # a single buffer that is reused for every datagram
+            self.buf = bytearray(WSD_MAX_LEN)
+            self.view = memoryview(self.buf)
+            return
+
+        self.bufs = [ctypes.create_string_buffer(WSD_MAX_LEN) for i in range(RECV_BATCH_SIZE)]
+        self.names = [ctypes.create_string_buffer(SOCKADDR_STORAGE_LEN) for i in range(RECV_BATCH_SIZE)]
+        self.controls = [ctypes.create_string_buffer(control_len) for i in range(RECV_BATCH_SIZE)]
+        self.iovs = (iovec * RECV_BATCH_SIZE)()
+        self.hdrs = (mmsghdr * RECV_BATCH_SIZE)()
+        for i in range(RECV_BATCH_SIZE):
+            self.iovs[i].iov_base = ctypes.cast(self.bufs[i], ctypes.c_void_p)
+            self.iovs[i].iov_len = WSD_MAX_LEN
+            self.hdrs[i].msg_hdr.msg_name = ctypes.cast(self.names[i], ctypes.c_void_p)
+            self.hdrs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            self.hdrs[i].msg_hdr.msg_iovlen = 1
+            if control_len:
+                self.hdrs[i].msg_hdr.msg_control = ctypes.cast(self.controls[i], ctypes.c_void_p)
+
+    def recv_pending(self, s):
+        """
+        Receive all datagrams that are pending on a socket as (msg, address,
+        ancdata) tuples. Draining the socket saves wake-ups of the event loop
+        when many datagrams arrive at once, e.g. when lots of hosts announce
+        themselves.
+        """
+        if libc_recvmmsg is None:
+            while True:
+                try:
+                    if self.control_len:
+                        n, ancdata, _, address = s.recvmsg_into([self.buf], self.control_len, socket.MSG_DONTWAIT)
+                    else:
+                        n, address = s.recvfrom_into(self.buf, WSD_MAX_LEN, socket.MSG_DONTWAIT)
+                        ancdata = []
+                except BlockingIOError:
+                    return
+
+                yield bytes(self.view[:n]), address, ancdata
+
+        while True:
+            for hdr in self.hdrs:
+                hdr.msg_hdr.msg_namelen = SOCKADDR_STORAGE_LEN
+                hdr.msg_hdr.msg_controllen = self.control_len
+
+            n = libc_recvmmsg(s.fileno(), self.hdrs, RECV_BATCH_SIZE, socket.MSG_DONTWAIT, None)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise OSError(err, os.strerror(err))
+
+            for i in range(n):
+                hdr = self.hdrs[i]
+                ancdata = []
+                if self.control_len:
+                    ancdata = unpack_ancillary(ctypes.string_at(self.controls[i], hdr.msg_hdr.msg_controllen))
+                yield (ctypes.string_at(self.bufs[i], hdr.msg_len),
+                       unpack_sockaddr(ctypes.string_at(self.names[i], hdr.msg_hdr.msg_namelen)), ancdata)
+
+            if n < RECV_BATCH_SIZE:
+                return
+
+
+class MulticastReceiver:
+    """
+    A socket that receives the WSD multicast traffic of an address family on
+    all interfaces. Received datagrams are passed to the MulticastHandlers of
+    the interface they arrived on. There is one instance per address family,
+    see get_instance.
+    """
+
+    instances = {}
+
+    @classmethod
+    def get_instance(cls, family, aio_loop):
+        if family not in cls.instances:
+            cls.instances[family] = cls(family, aio_loop)
+
+        return cls.instances[family]
+
+    def __init__(self, family, aio_loop):
+        self.family = family
+        self.aio_loop = aio_loop
+
+        # MulticastHandlers indexed by the index of their interface
+        self.handlers = {}
+
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tune_recv_socket(self.socket)
+        if family == socket.AF_INET:
+            self.group = socket.inet_pton(family, WSD_MCAST_GRP_V4)
+            self.socket.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+            self.socket.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+            try:
+                self.socket.bind((WSD_MCAST_GRP_V4, WSD_UDP_PORT))
+            except OSError:
+                self.socket.bind(('', WSD_UDP_PORT))
+        else:
+            self.group = socket.inet_pton(family, WSD_MCAST_GRP_V6)
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            try:
+                # supported starting from Linux 4.20
+                self.socket.setsockopt(socket.IPPROTO_IPV6, IPV6_MULTICAST_ALL, 0)
+            except OSError as e:
+                logger.warning('cannot unset all_multicast: {}'.format(e))
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+            # the link-local group cannot be bound without a scope
+            self.socket.bind(('::', WSD_UDP_PORT))
+
+        self.recv_batch = RecvBatch(PKTINFO_CONTROL_LEN)
+        self.aio_loop.add_reader(self.socket.fileno(), self.handle_request)
+
+    def cleanup(self):
+        self.aio_loop.remove_reader(self.socket.fileno())
+        self.socket.close()
+        del MulticastReceiver.instances[self.family]
+
+    def membership_request(self, idx):
+        if self.family == socket.AF_INET:
+            # v4: member_request (ip_mreqn) = { multicast_addr, intf_addr, idx }
+            return self.group + socket.inet_pton(self.family, '0.0.0.0') + struct.pack('@I', idx)
+
+        # v6: member_request = { multicast_addr, intf_idx }
+        return self.group + struct.pack('@I', idx)
+
+    def join(self, mch, idx):
+        """
+        Pass traffic received on an interface to a MulticastHandler. The
+        multicast group is joined on the interface for its first handler.
+        """
+        if idx not in self.handlers:
+            if self.family == socket.AF_INET:
+                self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self.membership_request(idx))
+            else:
+                self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, self.membership_request(idx))
+            self.handlers[idx] = []
+
+        self.handlers[idx].append(mch)
+
+    def leave(self, mch, idx):
+        """
+        Stop passing traffic to a MulticastHandler. The group is left on the
+        interface with its last handler. The receiver cleans up itself if
+        there are no handlers anymore.
+        """
+        if idx not in self.handlers or mch not in self.handlers[idx]:
+            return
+
+        self.handlers[idx].remove(mch)
+        if not self.handlers[idx]:
+            del self.handlers[idx]
+            try:
+                if self.family == socket.AF_INET:
+                    self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP,
+                                           self.membership_request(idx))
+                else:
+                    self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_LEAVE_GROUP,
+                                           self.membership_request(idx))
+            except OSError as e:
+                # the interface may be gone already
+                logger.debug('cannot leave multicast group on interface {}: {}'.format(idx, e))
+
+        if not self.handlers:
+            self.cleanup()
+
+    def get_packet_info(self, ancdata):
+        """get the interface index and the destination address from ancillary data"""
+        for level, cmsg_type, data in ancdata:
+            if level == socket.IPPROTO_IP and cmsg_type == IP_PKTINFO:
+                # struct in_pktinfo = { ifindex, spec_dst, addr }
+                idx, _, dst = struct.unpack_from('=i4s4s', data)
+                return idx, dst
+            if level == socket.IPPROTO_IPV6 and cmsg_type == socket.IPV6_PKTINFO:
+                # struct in6_pktinfo = { addr, ifindex }
+                dst, idx = struct.unpack_from('=16sI', data)
+                return idx, dst
+
+        return None, None
+
+    def handle_request(self):
+        for msg, address, ancdata in self.recv_batch.recv_pending(self.socket):
+            idx, dst = self.get_packet_info(ancdata)
+            # the socket is not bound to the group (IPv6), so drop unicast
+            if dst != self.group or idx not in self.handlers:
+                continue
+
+            for mch in self.handlers[idx]:
+                mch.handle_multicast(msg, address)
+
 
 class MulticastHandler:
     """
     A class for handling multicast traffic on a given interface for a
     given address family. It provides multicast sender and receiver sockets
     """
+    # buffers for receiving, shared by all instances: the sockets are read
+    # from the event loop only and each callback drains its socket before
+    # the next one runs, so the buffers are never in use twice
+    recv_batch = None
+
     # TODO: this one needs some cleanup
     def __init__(self, family, address, interface, aio_loop):
         # network address, family, and interface name
@@ -57,11 +411,18 @@ class MulticastHandler:
         self.interface = interface
 
         # create individual interface-bound sockets for:
-        #  - receiving multicast traffic
+        #  - receiving multicast traffic (unless the socket of a
+        #    MulticastReceiver is shared among all interfaces)
         #  - sending multicast from a socket bound to WSD port
         #  - sending unicast messages from a random port
-        self.recv_socket = socket.socket(self.family, socket.SOCK_DGRAM)
-        self.recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.receiver = None
+        if MULTICAST_RECEIVER:
+            self.receiver = MulticastReceiver.get_instance(family, aio_loop)
+            self.recv_socket = self.receiver.socket
+        else:
+            self.recv_socket = socket.socket(self.family, socket.SOCK_DGRAM)
+            self.recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tune_recv_socket(self.recv_socket)
         self.mc_send_socket = socket.socket(self.family, socket.SOCK_DGRAM)
         self.uc_send_socket = socket.socket(self.family, socket.SOCK_DGRAM)
         self.uc_send_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -74,32 +435,54 @@ class MulticastHandler:
         self.multicast_address = None
         self.listen_address = None
 
-        # dictionary that holds objects with a handle_request method for the
-        # sockets created above
-        self.message_handlers = {}
+        # the multicast address as sockaddr structure, see pack_sockaddr
+        self.multicast_sockaddr = None
+
+        # index of the interface, determined once in network setup
+        self.idx = None
+        # cleared when the sockets are closed, see cleanup
+        self.active = True
+
+        # lists of objects with a handle_request method for the datagrams
+        # received on the sockets created above, see add_handler
+        self.recv_handlers = []
+        self.mc_reply_handlers = []
+        self.uc_reply_handlers = []
         self.aio_loop = aio_loop
+        if MulticastHandler.recv_batch is None:
+            MulticastHandler.recv_batch = RecvBatch()
 
         if family == socket.AF_INET:
             self.init_v4()
         elif family == socket.AF_INET6:
             self.init_v6()
 
+        self.multicast_sockaddr = pack_sockaddr(self.family, self.multicast_address)
+
         logger.info('joined multicast group {0} on {2}%{1}'.format(self.multicast_address, self.interface.name,
                     self.address))
         logger.debug('transport address on {0} is {1}'.format(self.interface.name, self.transport_address))
         logger.debug('will listen for HTTP traffic on address {0}'.format(self.listen_address))
 
-        # register calbacks for incoming data (also for mc)
-        self.aio_loop.add_reader(self.recv_socket.fileno(), self.handle_request, self.recv_socket)
-        self.aio_loop.add_reader(self.mc_send_socket.fileno(), self.handle_request, self.mc_send_socket)
-        self.aio_loop.add_reader(self.uc_send_socket.fileno(), self.handle_request, self.uc_send_socket)
+        # register calbacks for incoming data (also for mc), there is a
+        # dedicated one for every socket
+        if self.receiver is None:
+            self.aio_loop.add_reader(self.recv_socket.fileno(), self.on_recv)
+        self.aio_loop.add_reader(self.mc_send_socket.fileno(), self.on_mc_reply)
+        self.aio_loop.add_reader(self.uc_send_socket.fileno(), self.on_uc_reply)
 
     def cleanup(self):
-        self.aio_loop.remove_reader(self.recv_socket)
+        self.active = False
+        if self.receiver is not None:
+            # the interface may be gone or renamed, so do not look it up again
+            self.receiver.leave(self, self.idx)
+        else:
+            self.aio_loop.remove_reader(self.recv_socket)
+            self.recv_socket.close()
+
         self.aio_loop.remove_reader(self.mc_send_socket)
         self.aio_loop.remove_reader(self.uc_send_socket)
 
-        self.recv_socket.close()
         self.mc_send_socket.close()
         self.uc_send_socket.close()
 
@@ -108,28 +491,23 @@ class MulticastHandler:
 
     def init_v6(self):
         idx = socket.if_nametoindex(self.interface.name)
+        self.idx = idx
         self.multicast_address = (WSD_MCAST_GRP_V6, WSD_UDP_PORT, 0x575C, idx)
 
-        # v6: member_request = { multicast_addr, intf_idx }
-        mreq = (socket.inet_pton(self.family, WSD_MCAST_GRP_V6) + struct.pack('@I', idx))
-        self.recv_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
-        self.recv_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        if self.receiver is not None:
+            self.receiver.join(self, idx)
+        else:
+            # v6: member_request = { multicast_addr, intf_idx }
+            mreq = (socket.inet_pton(self.family, WSD_MCAST_GRP_V6) + struct.pack('@I', idx))
+            self.recv_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+            self.recv_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
 
-        # Could anyone ask the Linux folks for the rationale for this!?
-        if platform.system() == 'Linux':
+            # bind to network interface, i.e. scope and handle OS differences,
+            # see Stevens: Unix Network Programming, Section 21.6, last paragraph
             try:
-                # supported starting from Linux 4.20
-                IPV6_MULTICAST_ALL = 29
-                self.recv_socket.setsockopt(socket.IPPROTO_IPV6, IPV6_MULTICAST_ALL, 0)
-            except OSError as e:
-                logger.warning('cannot unset all_multicast: {}'.format(e))
-
-        # bind to network interface, i.e. scope and handle OS differences,
-        # see Stevens: Unix Network Programming, Section 21.6, last paragraph
-        try:
-            self.recv_socket.bind((WSD_MCAST_GRP_V6, WSD_UDP_PORT, 0, idx))
-        except OSError:
-            self.recv_socket.bind(('::', 0, 0, idx))
+                self.recv_socket.bind((WSD_MCAST_GRP_V6, WSD_UDP_PORT, 0, idx))
+            except OSError:
+                self.recv_socket.bind(('::', 0, 0, idx))
 
         # bind unicast socket to interface address and WSD's udp port
         self.uc_send_socket.bind((self.address, WSD_UDP_PORT, 0, idx))
@@ -143,21 +521,20 @@ class MulticastHandler:
 
     def init_v4(self):
         idx = socket.if_nametoindex(self.interface.name)
+        self.idx = idx
         self.multicast_address = (WSD_MCAST_GRP_V4, WSD_UDP_PORT)
 
         # v4: member_request (ip_mreqn) = { multicast_addr, intf_addr, idx }
         mreq = (socket.inet_pton(self.family, WSD_MCAST_GRP_V4) + socket.inet_pton(self.family, self.address)
                 + struct.pack('@I', idx))
-        self.recv_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-
-        if platform.system() == 'Linux':
-            IP_MULTICAST_ALL = 49
-            self.recv_socket.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
-
-        try:
-            self.recv_socket.bind((WSD_MCAST_GRP_V4, WSD_UDP_PORT))
-        except OSError:
-            self.recv_socket.bind(('', WSD_UDP_PORT))
+        if self.receiver is not None:
+            self.receiver.join(self, idx)
+        else:
+            self.recv_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            try:
+                self.recv_socket.bind((WSD_MCAST_GRP_V4, WSD_UDP_PORT))
+            except OSError:
+                self.recv_socket.bind(('', WSD_UDP_PORT))
 
         # bind unicast socket to interface address and WSD's udp port
         self.uc_send_socket.bind((self.address, WSD_UDP_PORT))
@@ -168,48 +545,108 @@ class MulticastHandler:
 
         self.listen_address = (self.address, WSD_HTTP_PORT)
 
+    def get_handlers(self, s):
+        if s is self.recv_socket:
+            return self.recv_handlers
+        if s is self.mc_send_socket:
+            return self.mc_reply_handlers
+        return self.uc_reply_handlers
+
     def add_handler(self, socket, handler):
-        # try:
-        #    self.selector.register(socket, selectors.EVENT_READ, self)
-        # except KeyError:
-        #    # accept attempts of multiple registrations
-        #    pass
-
-        if socket in self.message_handlers:
-            self.message_handlers[socket].append(handler)
-        else:
-            self.message_handlers[socket] = [handler]
+        self.get_handlers(socket).append(handler)
 
     def remove_handler(self, socket, handler):
-        if socket in self.message_handlers:
-            if handler in self.message_handlers[socket]:
-                self.message_handlers[socket].remove(handler)
-
-    def handle_request(self, key):
-        s = None
-        if key == self.uc_send_socket:
-            s = self.uc_send_socket
-        elif key == self.mc_send_socket:
-            s = self.mc_send_socket
-        elif key == self.recv_socket:
-            s = self.recv_socket
-        else:
-            raise ValueError("Unknown socket passed as key.")
+        handlers = self.get_handlers(socket)
+        if handler in handlers:
+            handlers.remove(handler)
+
+    def on_recv(self):
+        for msg, address, _ in self.recv_batch.recv_pending(self.recv_socket):
+            self.handle_multicast(msg, address)
+
+    def handle_multicast(self, msg, address):
+        """pass a datagram received via the multicast group to the handlers"""
+        for handler in self.recv_handlers:
+            handler.handle_request(msg, address)
+
+    def on_mc_reply(self):
+        for msg, address, _ in self.recv_batch.recv_pending(self.mc_send_socket):
+            for handler in self.mc_reply_handlers:
+                handler.handle_request(msg, address)
 
-        msg, address = s.recvfrom(WSD_MAX_LEN)
-        if s in self.message_handlers:
-            for handler in self.message_handlers[s]:
+    def on_uc_reply(self):
+        for msg, address, _ in self.recv_batch.recv_pending(self.uc_send_socket):
+            for handler in self.uc_reply_handlers:
                 handler.handle_request(msg, address)
 
     def send(self, msg, addr):
         # Request from a client must be answered from a socket that is bound
         # to the WSD port, i.e. the recv_socket. Messages to multicast
-        # addresses are sent over the dedicated send socket.
-        if addr == self.multicast_address:
+        # addresses are sent over the dedicated send socket. The multicast
+        # address is usually passed as the very same object.
+        if addr is self.multicast_address or addr == self.multicast_address:
             self.mc_send_socket.sendto(msg, addr)
         else:
             self.uc_send_socket.sendto(msg, addr)
 
+    def send_batch(self, datagrams):
+        """
+        Send a list of (msg, addr) tuples. If libc_sendmmsg is set, all
+        datagrams that go out on the same socket are passed to the kernel
+        with a single call.
+        """
+        if libc_sendmmsg is None:
+            for msg, addr in datagrams:
+                # a single unreachable destination must not affect the others
+                try:
+                    self.send(msg, addr)
+                except OSError as e:
+                    logger.error('error while sending packet on {} to {}: {}'.format(self.interface.name, addr, e))
+            return
+
+        mc_msgs = []
+        uc_msgs = []
+        sockaddrs = {}
+        for msg, addr in datagrams:
+            if addr is self.multicast_address or addr == self.multicast_address:
+                mc_msgs.append((msg, addr, self.multicast_sockaddr))
+            else:
+                if addr not in sockaddrs:
+                    sockaddrs[addr] = pack_sockaddr(self.family, addr)
+                uc_msgs.append((msg, addr, sockaddrs[addr]))
+
+        if mc_msgs:
+            self.sendmmsg(self.mc_send_socket, mc_msgs)
+        if uc_msgs:
+            self.sendmmsg(self.uc_send_socket, uc_msgs)
+
+    def sendmmsg(self, s, msgs):
+        """send a list of (msg, addr, sockaddr) tuples over a socket using sendmmsg"""
+        count = len(msgs)
+        iovs = (iovec * count)()
+        hdrs = (mmsghdr * count)()
+        # point to the memory of the (immutable) bytes objects, do not copy;
+        # they are kept alive by the msgs list
+        for (msg, _, sockaddr), iov, hdr in zip(msgs, iovs, hdrs):
+            iov.iov_base = ctypes.cast(ctypes.c_char_p(msg), ctypes.c_void_p)
+            iov.iov_len = len(msg)
+            hdr.msg_hdr.msg_name = ctypes.cast(ctypes.c_char_p(sockaddr), ctypes.c_void_p)
+            hdr.msg_hdr.msg_namelen = len(sockaddr)
+            hdr.msg_hdr.msg_iov = ctypes.pointer(iov)
+            hdr.msg_hdr.msg_iovlen = 1
+
+        sent = 0
+        while sent < count:
+            n = libc_sendmmsg(s.fileno(), ctypes.byref(hdrs, sent * ctypes.sizeof(mmsghdr)), count - sent, 0)
+            if n < 0:
+                # sendmmsg stops at the first datagram that cannot be sent,
+                # skip it and continue with the remaining ones
+                err = ctypes.get_errno()
+                logger.error('error while sending packet on {} to {}: {}'.format(
+                    self.interface.name, msgs[sent][1], os.strerror(err)))
+                n = 1
+            sent += n
+
 
 # constants for WSD XML/SOAP parsing
 WSA_URI = 'http://schemas.xmlsoap.org/ws/2004/08/addressing'
@@ -226,6 +663,9 @@ namespaces = {
     'pub': 'http://schemas.microsoft.com/windows/pub/2005/07'
 }
 
+for prefix, uri in namespaces.items():
+    ElementTree.register_namespace(prefix, uri)
+
 WSD_MAX_KNOWN_MESSAGES = 10
 
 WSD_PROBE = WSD_URI + '/Probe'
@@ -249,6 +689,46 @@ WSA_DISCOVERY = 'urn:schemas-xmlsoap-org:ws:2005:04:discovery'
 
 MIME_TYPE_SOAP_XML = 'application/soap+xml'
 
+# serialized bodies of replies with a fixed structure, the values to be
+# filled in must be escaped (see xml_escape)
+PROBE_MATCH_TEMPLATE = (
+    '<wsd:ProbeMatches><wsd:ProbeMatch>'
+    '<wsa:EndpointReference><wsa:Address>%(endpoint)s</wsa:Address></wsa:EndpointReference>'
+    '<wsd:Types>%(types)s</wsd:Types>'
+    '<wsd:MetadataVersion>1</wsd:MetadataVersion>'
+    '</wsd:ProbeMatch></wsd:ProbeMatches>')
+
+RESOLVE_MATCH_TEMPLATE = (
+    '<wsd:ResolveMatches><wsd:ResolveMatch>'
+    '<wsa:EndpointReference><wsa:Address>%(endpoint)s</wsa:Address></wsa:EndpointReference>'
+    '<wsd:Types>%(types)s</wsd:Types>'
+    '<wsd:XAddrs>%(xaddrs)s</wsd:XAddrs>'
+    '<wsd:MetadataVersion>1</wsd:MetadataVersion>'
+    '</wsd:ResolveMatch></wsd:ResolveMatches>')
+
+# see https://msdn.microsoft.com/en-us/library/hh441784.aspx for an example.
+# Some of the properties below might be made configurable in future releases.
+GET_RESPONSE_TEMPLATE = (
+    '<wsx:Metadata>'
+    '<wsx:MetadataSection Dialect="' + WSDP_URI + '/ThisDevice"><wsdp:ThisDevice>'
+    '<wsdp:FriendlyName>WSD Device %(hostname)s</wsdp:FriendlyName>'
+    '<wsdp:FirmwareVersion>1.0</wsdp:FirmwareVersion>'
+    '<wsdp:SerialNumber>1</wsdp:SerialNumber>'
+    '</wsdp:ThisDevice></wsx:MetadataSection>'
+    '<wsx:MetadataSection Dialect="' + WSDP_URI + '/ThisModel"><wsdp:ThisModel>'
+    '<wsdp:Manufacturer>wsdd</wsdp:Manufacturer>'
+    '<wsdp:ModelName>wsdd</wsdp:ModelName>'
+    '<pnpx:DeviceCategory>Computers</pnpx:DeviceCategory>'
+    '</wsdp:ThisModel></wsx:MetadataSection>'
+    '<wsx:MetadataSection Dialect="' + WSDP_URI + '/Relationship">'
+    '<wsdp:Relationship Type="' + WSDP_URI + '/host"><wsdp:Host>'
+    '<wsa:EndpointReference><wsa:Address>%(endpoint)s</wsa:Address></wsa:EndpointReference>'
+    '<wsdp:Types>' + PUB_COMPUTER + '</wsdp:Types>'
+    '<wsdp:ServiceId>%(endpoint)s</wsdp:ServiceId>'
+    '<' + PUB_COMPUTER + '>%(computer)s</' + PUB_COMPUTER + '>'
+    '</wsdp:Host></wsdp:Relationship></wsx:MetadataSection>'
+    '</wsx:Metadata>')
+
 # protocol assignments (WSD spec/Section 2.4)
 WSD_UDP_PORT = 3702
 WSD_HTTP_PORT = 5357
@@ -263,20 +743,189 @@ UDP_MIN_DELAY = 50
 UDP_MAX_DELAY = 250
 UDP_UPPER_DELAY = 500
 
+# timeout for fetching metadata via HTTP in seconds
+METADATA_TIMEOUT = 2.0
+HTTP_CLIENT_ERRORS = (OSError, asyncio.TimeoutError) + ((aiohttp.ClientError,) if aiohttp is not None else ())
+
 # servers must recond in 4 seconds after probe arrives
 PROBE_TIMEOUT = 4
 MAX_STARTUP_PROBE_DELAY = 3
 
+# placeholders in serialized message templates, see fill_message_template
+TEMPLATE_MESSAGE_ID = '__MID__'
+TEMPLATE_MESSAGE_NUMBER = '__MNUM__'
+
+# maximum number of queued datagrams handled in one go by the sender
+SEND_BATCH_SIZE = 100
+
 # some globals
 wsd_instance_id = int(time.time())
-send_queue = []
+# all messages of this instance form a single sequence, ordered by their
+# message number
+wsd_sequence_id = uuid.uuid4().urn
+send_queue = None
+sender_task = None
+http_session = None
 
 args = None
 logger = None
 
 
+def qualified_tag(tag):
+    """Expand a tag given as prefix:name to {uri}name."""
+    prefix, _, name = tag.partition(':')
+    return '{{{0}}}{1}'.format(namespaces[prefix], name)
+
+
+def ns_tag(tag):
+    """
+    Get the name for a tag given as prefix:name that is accepted by the XML
+    module in use. lxml requires qualified {uri}name tags while the standard
+    module writes prefixed names as-is (declarations are set on the envelope).
+    """
+    return qualified_tag(tag) if XML_USE_LXML else tag
+
+
+def compile_path(path):
+    """
+    Compile a path of child steps (prefix:name or *) into a function that
+    returns the list of matching elements below a given element. This avoids
+    parsing the path and resolving its namespaces for every message.
+    """
+    if XML_USE_LXML:
+        return ElementTree.XPath(path, namespaces=namespaces)
+
+    steps = [step if step == '*' else qualified_tag(step) for step in path.split('/') if step not in ('', '.')]
+
+    def select(elem):
+        nodes = [elem]
+        for step in steps:
+            nodes = [child for node in nodes for child in node if step == '*' or child.tag == step]
+        return nodes
+
+    return select
+
+
+def select_first(path, elem):
+    """Get the first element matched by a compiled path or None."""
+    nodes = path(elem)
+    return nodes[0] if nodes else None
+
+
+def select_text(path, elem, default=None):
+    """Get the text of the first element matched by a compiled path like findtext() does."""
+    nodes = path(elem)
+    return (nodes[0].text or '') if nodes else default
+
+
+def xml_escape(text):
+    """escape text for use in element content or attribute values"""
+    return xml.sax.saxutils.escape(text, {'"': '&quot;'})
+
+
+def build_envelope(to_addr, action, msg_id, relates_to=None, header=b'', body=b''):
+    """
+    Build a serialized SOAP envelope from the values of the header elements
+    every WSD message carries, additional serialized header elements and
+    the serialized body.
+    """
+    chunks = [ENVELOPE_START, b'<soap:Header><wsa:To>', xml_escape(to_addr).encode('utf-8'),
+              b'</wsa:To><wsa:Action>', xml_escape(action).encode('utf-8'),
+              b'</wsa:Action><wsa:MessageID>', xml_escape(msg_id).encode('utf-8'), b'</wsa:MessageID>']
+    if relates_to is not None:
+        chunks.extend((b'<wsa:RelatesTo>', xml_escape(relates_to).encode('utf-8'), b'</wsa:RelatesTo>'))
+    chunks.extend((header, b'</soap:Header>'))
+    if body:
+        chunks.extend((b'<soap:Body>', body, b'</soap:Body></soap:Envelope>'))
+    else:
+        chunks.append(b'<soap:Body /></soap:Envelope>')
+
+    return b''.join(chunks)
+
+
+# outgoing messages are composed of serialized chunks, all namespaces are
+# declared on the envelope
+ENVELOPE_START = ("<?xml version='1.0' encoding='utf-8'?>\n<soap:Envelope " + ' '.join(
+    'xmlns:{0}="{1}"'.format(prefix, xml_escape(uri)) for prefix, uri in namespaces.items()) + '>').encode('utf-8')
+
+# paths into incoming messages
+XP_HEADER = compile_path('./soap:Header')
+XP_BODY = compile_path('./soap:Body')
+XP_MESSAGE_ID = compile_path('./wsa:MessageID')
+XP_ACTION = compile_path('./wsa:Action')
+XP_RELATES_TO = compile_path('./wsa:RelatesTo')
+XP_ENDPOINT_ADDRESS = compile_path('./wsa:EndpointReference/wsa:Address')
+XP_PROBE = compile_path('./wsd:Probe')
+XP_PROBE_SCOPES = compile_path('./wsd:Scopes')
+XP_PROBE_TYPES = compile_path('./wsd:Types')
+XP_RESOLVE = compile_path('./wsd:Resolve')
+XP_METADATA_SECTIONS = compile_path('./soap:Body/wsx:Metadata/wsx:MetadataSection')
+XP_RELATIONSHIP = compile_path('./wsdp:Relationship')
+XP_HOST = compile_path('./wsdp:Host')
+XP_HOST_TYPES = compile_path('./wsdp:Types')
+XP_HOST_COMPUTER = compile_path('./' + PUB_COMPUTER)
+XP_WSDP_PROPS = {
+    WSDP_URI + '/ThisDevice': compile_path('./wsdp:ThisDevice/*'),
+    WSDP_URI + '/ThisModel': compile_path('./wsdp:ThisModel/*'),
+}
+XP_ENDPOINT_METADATA = {
+    prefix: (compile_path(prefix + '/wsa:EndpointReference/wsa:Address'), compile_path(prefix + '/wsd:XAddrs'))
+    for prefix in ['wsd:Hello', 'wsd:Bye', 'wsd:ProbeMatches/wsd:ProbeMatch', 'wsd:ResolveMatches/wsd:ResolveMatch']
+}
+
+
+async def post_request(url, body, headers):
+    """
+    Send a HTTP POST request and return the body of the response. Uses
+    aiohttp if present.
+    """
+    global http_session
+
+    if aiohttp is not None:
+        if http_session is None:
+            http_session = aiohttp.ClientSession()
+
+        async with http_session.post(url, data=body, headers=headers, raise_for_status=True) as response:
+            return await response.read()
+
+    # HTTP/1.0 is sufficient: the server closes the connection after the
+    # response, so there is no need to handle chunks
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == 'https'
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or (443 if https else 80),
+                                                   ssl=https)
+    try:
+        request = 'POST {} HTTP/1.0\r\n'.format(urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, '')))
+        request_headers = {'Host': parts.netloc}
+        request_headers.update(headers)
+        request_headers['Content-Length'] = len(body)
+        request += ''.join('{}: {}\r\n'.format(key, value) for key, value in request_headers.items())
+        writer.write(request.encode('ascii') + b'\r\n' + body)
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, content = response.partition(b'\r\n\r\n')
+    status_line = head.partition(b'\r\n')[0].decode('ascii', 'replace')
+    if status_line.split(None, 2)[1:2] != ['200']:
+        raise urllib.error.URLError('unexpected response: {}'.format(status_line))
+
+    return content
+
+
+async def close_http_session():
+    global http_session
+
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+
 class WSDMessageHandler:
-    known_messages = collections.deque([], WSD_MAX_KNOWN_MESSAGES)
+    # IDs of recently seen messages: the set is used for lookups, the deque
+    # tracks the order in which IDs are dropped from the set again
+    known_message_set = set()
+    known_message_order = collections.deque([], WSD_MAX_KNOWN_MESSAGES)
 
     def __init__(self):
         self.handlers = {}
@@ -287,72 +936,71 @@ class WSDMessageHandler:
 
     # shortcuts for building WSD responses
     def add_endpoint_reference(self, parent, endpoint=None):
-        epr = ElementTree.SubElement(parent, 'wsa:EndpointReference')
-        address = ElementTree.SubElement(epr, 'wsa:Address')
+        epr = ElementTree.SubElement(parent, ns_tag('wsa:EndpointReference'))
+        address = ElementTree.SubElement(epr, ns_tag('wsa:Address'))
         if endpoint is None:
             address.text = args.uuid.urn
         else:
             address.text = endpoint
 
     def add_metadata_version(self, parent):
-        meta_data = ElementTree.SubElement(parent, 'wsd:MetadataVersion')
+        meta_data = ElementTree.SubElement(parent, ns_tag('wsd:MetadataVersion'))
         meta_data.text = '1'
 
-    def add_types(self, parent):
-        dev_type = ElementTree.SubElement(parent, 'wsd:Types')
-        dev_type.text = WSD_TYPE_DEVICE_COMPUTER
-
     def add_xaddr(self, parent, transport_addr):
         if transport_addr:
-            item = ElementTree.SubElement(parent, 'wsd:XAddrs')
+            item = ElementTree.SubElement(parent, ns_tag('wsd:XAddrs'))
             item.text = 'http://{0}:{1}/{2}'.format(transport_addr, WSD_HTTP_PORT, args.uuid)
 
     def build_message(self, to_addr, action_str, request_header, response):
-        retval = self.xml_to_buffer(self.build_message_tree(to_addr, action_str, request_header, response)[0])
+        retval = self.serialize_message(to_addr, action_str, request_header, response)[0]
 
         logger.debug('constructed xml for WSD message: {0}'.format(retval))
 
         return retval
 
-    def build_message_tree(self, to_addr, action_str, request_header, body):
+    def serialize_message(self, to_addr, action_str, request_header, body, template=False):
         """
         Build a WSD message with a given action string including SOAP header.
 
         The message can be constructed based on a response to another
         message (given by its header) and with a optional response that
-        serves as the message's body
+        serves as the message's body, either as element or already
+        serialized. For a template, the values that change
+        with every message are left as placeholders.
         """
-        root = ElementTree.Element('soap:Envelope')
-        header = ElementTree.SubElement(root, 'soap:Header')
+        msg_id = TEMPLATE_MESSAGE_ID if template else uuid.uuid4().urn
 
-        to = ElementTree.SubElement(header, 'wsa:To')
-        to.text = to_addr
-
-        action = ElementTree.SubElement(header, 'wsa:Action')
-        action.text = action_str
-
-        msg_id = ElementTree.SubElement(header, 'wsa:MessageID')
-        msg_id.text = uuid.uuid1().urn
-
-        if request_header:
-            req_msg_id = request_header.find('./wsa:MessageID', namespaces)
+        relates_to = None
+        if request_header is not None:
+            req_msg_id = select_first(XP_MESSAGE_ID, request_header)
             if req_msg_id is not None:
-                relates_to = ElementTree.SubElement(header, 'wsa:RelatesTo')
-                relates_to.text = req_msg_id.text
+                relates_to = req_msg_id.text or ''
 
-        self.add_header_elements(header, action_str)
+        header = self.header_elements(action_str, template)
+        if body is None:
+            body = b''
+        elif not isinstance(body, bytes):
+            # only used for templates built once, the element redeclares the
+            # namespaces of the envelope which is harmless
+            body = ElementTree.tostring(body)
 
-        body_root = ElementTree.SubElement(root, 'soap:Body')
-        if body is not None:
-            body_root.append(body)
+        return build_envelope(to_addr, action_str, msg_id, relates_to, header, body), msg_id
 
-        for prefix, uri in namespaces.items():
-            root.attrib['xmlns:' + prefix] = uri
+    def build_message_template(self, to_addr, action_str, body):
+        """
+        Serialize a message that is sent repeatedly with the same content
+        once. Use fill_message_template to get an actual message from it.
+        """
+        return self.serialize_message(to_addr, action_str, None, body, True)[0]
 
-        return root, msg_id.text
+    def fill_message_template(self, template):
+        msg_id = uuid.uuid4().urn
+        return template.replace(TEMPLATE_MESSAGE_ID.encode(), msg_id.encode()), msg_id
 
-    def add_header_elements(self, header, extra):
-        pass
+    def header_elements(self, extra, template=False):
+        """get serialized header elements specific to the message type"""
+        return b''
 
     def handle_message(self, msg, mch, src_address):
         """
@@ -363,11 +1011,11 @@ class WSDMessageHandler:
         except ElementTree.ParseError:
             return None
 
-        header = tree.find('./soap:Header', namespaces)
+        header = select_first(XP_HEADER, tree)
         if header is None:
             return None
 
-        msg_id_tag = header.find('./wsa:MessageID', namespaces)
+        msg_id_tag = select_first(XP_MESSAGE_ID, header)
         if msg_id_tag is None:
             return None
 
@@ -378,8 +1026,8 @@ class WSDMessageHandler:
             logger.debug('known message ({0}): dropping it'.format(msg_id))
             return None
 
-        action_tag = header.find('./wsa:Action', namespaces)
-        if action_tag is None:
+        action_tag = select_first(XP_ACTION, header)
+        if action_tag is None or not action_tag.text:
             return None
 
         action = action_tag.text
@@ -392,7 +1040,7 @@ class WSDMessageHandler:
             # http logging is already done by according server
             logger.debug('processing WSD {} message ({})'.format(action_method, msg_id))
 
-        body = tree.find('./soap:Body', namespaces)
+        body = select_first(XP_BODY, tree)
         if body is None:
             return None
 
@@ -415,18 +1063,81 @@ class WSDMessageHandler:
 
         Implements SOAP-over-UDP Appendix II Item 2
         """
-        if msg_id in type(self).known_messages:
+        cls = type(self)
+        if msg_id in cls.known_message_set:
             return True
 
-        type(self).known_messages.append(msg_id)
+        if len(cls.known_message_order) == WSD_MAX_KNOWN_MESSAGES:
+            cls.known_message_set.discard(cls.known_message_order.popleft())
+
+        cls.known_message_order.append(msg_id)
+        cls.known_message_set.add(msg_id)
 
         return False
 
-    def xml_to_buffer(self, xml):
-        retval = b'<?xml version="1.0" encoding="utf-8"?>'
-        retval = retval + ElementTree.tostring(xml, encoding='utf-8')
 
-        return retval
+def queue_datagram(mch, msg, address, done=None):
+    """
+    Queue a datagram to be sent via a MulticastHandler by the sender task,
+    which is started on first use. The optional future done is resolved once
+    the datagram was sent.
+    """
+    global send_queue, sender_task
+
+    if sender_task is None:
+        send_queue = asyncio.Queue()
+        sender_task = mch.aio_loop.create_task(send_datagrams(send_queue))
+
+    send_queue.put_nowait((mch, msg, address, done))
+
+
+async def send_datagrams(queue):
+    """
+    Consume the send queue. All datagrams that are available at once are
+    grouped by their MulticastHandler and sent as a batch.
+    """
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < SEND_BATCH_SIZE:
+            try:
+                batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        datagrams = {}
+        for mch, msg, address, done in batch:
+            datagrams.setdefault(mch, []).append((msg, address))
+
+        for mch, msgs in datagrams.items():
+            # datagrams may still be queued for handlers that were cleaned
+            # up in the meantime, e.g. when their address was removed
+            if not mch.active:
+                continue
+
+            try:
+                mch.send_batch(msgs)
+            except Exception as e:
+                logger.error('error while sending packets on {}: {}'.format(mch.interface.name, e))
+
+        for mch, msg, address, done in batch:
+            if done is not None and not done.done():
+                done.set_result(None)
+
+
+async def stop_sender():
+    global send_queue, sender_task
+
+    if sender_task is None:
+        return
+
+    sender_task.cancel()
+    try:
+        await sender_task
+    except asyncio.CancelledError:
+        pass
+
+    send_queue = None
+    sender_task = None
 
 
 class WSDUDPMessageHandler(WSDMessageHandler):
@@ -440,43 +1151,80 @@ class WSDUDPMessageHandler(WSDMessageHandler):
         self.mch = mch
         self.tearing_down = False
 
+        # handles of scheduled repetitions of sent messages
+        self.scheduled_sends = []
+
+    def cleanup(self):
+        super().cleanup()
+
+        # repetitions are still sent when tearing down (Bye), but the socket
+        # may be gone already if the address was removed
+        if not self.tearing_down:
+            for handle in self.scheduled_sends:
+                handle.cancel()
+            self.scheduled_sends.clear()
+
     def teardown(self):
         self.tearing_down = True
 
-    def send_datagram(self, msg, dst):
-        try:
-            self.mch.send(msg, dst)
-        except Exception as e:
-            logger.error('error while sending packet on {}: {}'.format(self.mch.interface.name, e))
+    def send_datagram(self, msg, dst, done=None):
+        queue_datagram(self.mch, msg, dst, done)
 
-    def enqueue_datagram(self, msg, address=None, msg_type=None):
+    def create_pending_future(self):
+        """
+        Create a future for a datagram to be sent, which the shutdown waits
+        for, e.g. to make sure the Bye message is sent completely.
+        """
+        done = self.mch.aio_loop.create_future()
+        self.pending_tasks.append(done)
+        return done
+
+    def enqueue_datagram(self, msg, address=None, msg_type=None, burst=False):
+        """
+        Schedule sending a message. With burst set, all repetitions are
+        queued at once and sent with a single system call if the platform
+        supports it instead of being spread in time.
+
+        Bursts give up the randomized back-off of SOAP over UDP, Appendix I:
+        a short loss on the link drops all copies. They are therefore only
+        used when tearing down (Bye), where the shutdown must not wait for
+        the repetitions; other messages keep their spacing.
+        """
         if not address:
             address = self.mch.multicast_address
 
         if msg_type:
             logger.info('scheduling {0} message via {1} to {2}'.format(msg_type, self.mch.interface.name, address))
 
-        schedule_task = self.mch.aio_loop.create_task(self.schedule_datagram(msg, address))
-        # Add this task to the pending list during teardown to wait during shutdown
-        if self.tearing_down:
-            self.pending_tasks.append(schedule_task)
+        msg_count = MULTICAST_UDP_REPEAT if address == self.mch.multicast_address else UNICAST_UDP_REPEAT
+        if burst and libc_sendmmsg is not None:
+            for i in range(msg_count - 1):
+                self.send_datagram(msg, address)
+            self.send_datagram(msg, address, self.create_pending_future() if self.tearing_down else None)
+        else:
+            self.schedule_datagram(msg, address, msg_count)
 
-    async def schedule_datagram(self, msg, address):
+    def schedule_datagram(self, msg, address, msg_count):
         """
-        Schedule to send the given message to the given address.
+        Send the given message to the given address and schedule its
+        repetitions with the event loop.
 
         Implements SOAP over UDP, Appendix I.
         """
+        aio_loop = self.mch.aio_loop
+        now = aio_loop.time()
+        self.scheduled_sends = [h for h in self.scheduled_sends if h.when() > now]
 
         self.send_datagram(msg, address)
 
-        delta = 0
-        msg_count = MULTICAST_UDP_REPEAT if address == self.mch.multicast_address else UNICAST_UDP_REPEAT
+        delay = 0
         delta = random.randint(UDP_MIN_DELAY, UDP_MAX_DELAY)
         for i in range(msg_count - 1):
-            await asyncio.sleep(delta / 1000.0)
-            self.send_datagram(msg, address)
+            delay += delta
             delta = min(delta * 2, UDP_UPPER_DELAY)
+            # let the shutdown wait for the last repetition
+            done = self.create_pending_future() if self.tearing_down and i == msg_count - 2 else None
+            self.scheduled_sends.append(aio_loop.call_later(delay / 1000.0, self.send_datagram, msg, address, done))
 
 
 class WSDDiscoveredDevice:
@@ -489,6 +1237,9 @@ class WSDDiscoveredDevice:
         self.addresses = {}
         self.props = {}
         self.display_name = ''
+        # formatted entry for the list command without the addresses, built
+        # when requested
+        self.list_row = None
 
         self.update(xml_str, xaddr, interface)
 
@@ -497,8 +1248,8 @@ class WSDDiscoveredDevice:
             tree = ETfromString(xml_str)
         except ElementTree.ParseError:
             return None
-        mds_path = 'soap:Body/wsx:Metadata/wsx:MetadataSection'
-        sections = tree.findall(mds_path, namespaces)
+        self.list_row = None
+        sections = XP_METADATA_SECTIONS(tree)
         for section in sections:
             dialect = section.attrib['Dialect']
             if dialect == WSDP_URI + '/ThisDevice':
@@ -506,9 +1257,9 @@ class WSDDiscoveredDevice:
             elif dialect == WSDP_URI + '/ThisModel':
                 self.extract_wsdp_props(section, dialect)
             elif dialect == WSDP_URI + '/Relationship':
-                host_xpath = 'wsdp:Relationship[@Type="{}/host"]/wsdp:Host'.format(WSDP_URI)
-                host_sec = section.find(host_xpath, namespaces)
-                if (host_sec):
+                host_sec = next((host for rel in XP_RELATIONSHIP(section) if rel.get('Type') == WSDP_URI + '/host'
+                                 for host in XP_HOST(rel)), None)
+                if host_sec is not None:
                     self.extract_host_props(host_sec)
             else:
                 logger.debug('unknown metadata dialect ({})'.format(dialect))
@@ -532,10 +1283,23 @@ class WSDDiscoveredDevice:
 
         logger.debug(str(self.props))
 
+    def get_list_row(self):
+        if self.list_row is None:
+            self.list_row = '{}\t{}\t{}\t'.format(
+                self.display_name,
+                self.props['BelongsTo'] if 'BelongsTo' in self.props else '',
+                datetime.datetime.fromtimestamp(self.last_seen).isoformat('T', 'seconds')).encode('utf-8')
+
+        # interfaces may be renamed at any time, so the addresses with their
+        # interface names are not cached
+        addrs_str = ','.join(', '.join('{}%{}'.format(a, mci.interface.name) for a in addrs)
+                             for mci, addrs in self.addresses.items())
+
+        return self.list_row + addrs_str.encode('utf-8') + b'\n'
+
     def extract_wsdp_props(self, root, dialect):
-        _, _, propsRoot = dialect.rpartition('/')
         # XPath support is limited, so filter by namespace on our own
-        nodes = root.findall('./wsdp:{0}/*'.format(propsRoot), namespaces)
+        nodes = XP_WSDP_PROPS[dialect](root)
         ns_prefix = '{{{}}}'.format(WSDP_URI)
         prop_nodes = [n for n in nodes if n.tag.startswith(ns_prefix)]
         for node in prop_nodes:
@@ -543,12 +1307,12 @@ class WSDDiscoveredDevice:
             self.props[tag_name] = node.text
 
     def extract_host_props(self, root):
-        types = root.findtext('wsdp:Types', '', namespaces)
+        types = select_text(XP_HOST_TYPES, root, '')
         self.props['types'] = types.split(' ')
         if types != PUB_COMPUTER:
             return
 
-        comp = root.findtext(PUB_COMPUTER, '', namespaces)
+        comp = select_text(XP_HOST_COMPUTER, root, '')
         self.props['DisplayName'], _, self.props['BelongsTo'] = (
             comp.partition('/'))
 
@@ -556,16 +1320,26 @@ class WSDDiscoveredDevice:
 class WSDClient(WSDUDPMessageHandler):
 
     instances = []
+    # instances indexed by their interface; the interface object is used as
+    # key since interfaces are renamed in place, see add_interface
+    by_interface = {}
 
     def __init__(self, mch):
         super().__init__(mch)
 
         WSDClient.instances.append(self)
+        WSDClient.by_interface.setdefault(mch.interface, []).append(self)
 
         self.mch.add_handler(self.mch.mc_send_socket, self)
         self.mch.add_handler(self.mch.recv_socket, self)
 
-        self.probes = {}
+        # IDs of sent probes in the order they were sent, with their time
+        self.probes = collections.OrderedDict()
+        self.metadata_tasks = set()
+
+        probe = ElementTree.Element(ns_tag('wsd:Probe'))
+        ElementTree.SubElement(probe, ns_tag('wsd:Types')).text = WSD_TYPE_DEVICE
+        self.probe_template = self.build_message_template(WSA_DISCOVERY, WSD_PROBE, probe)
 
         self.handlers[WSD_HELLO] = self.handle_hello
         self.handlers[WSD_BYE] = self.handle_bye
@@ -579,19 +1353,23 @@ class WSDClient(WSDUDPMessageHandler):
     def cleanup(self):
         super().cleanup()
         WSDClient.instances.remove(self)
+        clients = WSDClient.by_interface[self.mch.interface]
+        clients.remove(self)
+        if not clients:
+            del WSDClient.by_interface[self.mch.interface]
 
         self.mch.remove_handler(self.mch.mc_send_socket, self)
         self.mch.remove_handler(self.mch.recv_socket, self)
 
+        for task in self.metadata_tasks:
+            task.cancel()
+
     def send_probe(self):
         """WS-Discovery, Section 4.3, Probe message"""
         self.remove_outdated_probes()
 
-        probe = ElementTree.Element('wsd:Probe')
-        ElementTree.SubElement(probe, 'wsd:Types').text = WSD_TYPE_DEVICE
-
-        xml, i = self.build_message_tree(WSA_DISCOVERY, WSD_PROBE, None, probe)
-        self.enqueue_datagram(self.xml_to_buffer(xml), msg_type='Probe')
+        msg, i = self.fill_message_template(self.probe_template)
+        self.enqueue_datagram(msg, msg_type='Probe')
         self.probes[i] = time.time()
 
     def teardown(self):
@@ -625,7 +1403,7 @@ class WSDClient(WSDUDPMessageHandler):
             return
 
         logger.info('Hello from {} on {}'.format(endpoint, xaddr))
-        self.perform_metadata_exchange(endpoint, xaddr)
+        self.start_metadata_exchange(endpoint, xaddr)
 
     def handle_bye(self, header, body):
         bye_path = 'wsd:Bye'
@@ -636,7 +1414,7 @@ class WSDClient(WSDUDPMessageHandler):
 
     def handle_probe_match(self, header, body):
         # do not handle to probematches issued not sent by ourself
-        rel_msg = header.findtext('wsa:RelatesTo', None, namespaces)
+        rel_msg = select_text(XP_RELATES_TO, header)
         if rel_msg not in self.probes:
             logger.debug("unknown probe {}".format(rel_msg))
             return None
@@ -652,10 +1430,10 @@ class WSDClient(WSDUDPMessageHandler):
 
         xaddr = xaddrs.strip()
         logger.debug('probe match for {} on {}'.format(endpoint, xaddr))
-        self.perform_metadata_exchange(endpoint, xaddr)
+        self.start_metadata_exchange(endpoint, xaddr)
 
     def build_resolve_message(self, endpoint):
-        resolve = ElementTree.Element('wsd:Resolve')
+        resolve = ElementTree.Element(ns_tag('wsd:Resolve'))
         self.add_endpoint_reference(resolve, endpoint)
 
         return self.build_message(WSA_DISCOVERY, WSD_RESOLVE, None, resolve)
@@ -669,18 +1447,22 @@ class WSDClient(WSDUDPMessageHandler):
 
         xaddr = xaddrs.strip()
         logger.debug('resolve match for {} on {}'.format(endpoint, xaddr))
-        self.perform_metadata_exchange(endpoint, xaddr)
+        self.start_metadata_exchange(endpoint, xaddr)
 
     def extract_endpoint_metadata(self, body, prefix):
-        prefix = prefix + '/'
-        addr_path = 'wsa:EndpointReference/wsa:Address'
+        addr_path, xaddrs_path = XP_ENDPOINT_METADATA[prefix]
 
-        endpoint = body.findtext(prefix + addr_path, namespaces=namespaces)
-        xaddrs = body.findtext(prefix + 'wsd:XAddrs', namespaces=namespaces)
+        endpoint = select_text(addr_path, body)
+        xaddrs = select_text(xaddrs_path, body)
 
         return endpoint, xaddrs
 
-    def perform_metadata_exchange(self, endpoint, xaddr):
+    def start_metadata_exchange(self, endpoint, xaddr):
+        task = self.mch.aio_loop.create_task(self.perform_metadata_exchange(endpoint, xaddr))
+        self.metadata_tasks.add(task)
+        task.add_done_callback(self.metadata_tasks.discard)
+
+    async def perform_metadata_exchange(self, endpoint, xaddr):
         if not (xaddr.startswith('http://') or xaddr.startswith('https://')):
             logger.debug('invalid XAddr: {}'.format(xaddr))
             return
@@ -692,21 +1474,20 @@ class WSDClient(WSDUDPMessageHandler):
             url = url.replace(']', '%{}]'.format(self.mch.interface.name))
 
         body = self.build_getmetadata_message(endpoint)
-        request = urllib.request.Request(url, data=body, method='POST')
-        request.add_header('Content-Type', 'application/soap+xml')
-        request.add_header('User-Agent', 'wsdd')
+        headers = {'Content-Type': 'application/soap+xml', 'User-Agent': 'wsdd'}
         if host is not None:
-            request.add_header('Host', host)
+            headers['Host'] = host
 
         try:
-            with urllib.request.urlopen(request, None, 2.0) as stream:
-                self.handle_metadata(stream.read(), endpoint, xaddr)
-        except urllib.error.URLError as e:
+            meta = await asyncio.wait_for(post_request(url, body, headers), METADATA_TIMEOUT)
+        except HTTP_CLIENT_ERRORS as e:
             logger.warning('could not fetch metadata from: {} {}'.format(url, e))
+            return
+
+        self.handle_metadata(meta, endpoint, xaddr)
 
     def build_getmetadata_message(self, endpoint):
-        tree, _ = self.build_message_tree(endpoint, WSD_GET, None, None)
-        return self.xml_to_buffer(tree)
+        return self.serialize_message(endpoint, WSD_GET, None, None)[0]
 
     def handle_metadata(self, meta, endpoint, xaddr):
         device_uuid = str(uuid.UUID(endpoint))
@@ -717,18 +1498,19 @@ class WSDClient(WSDUDPMessageHandler):
 
     def remove_outdated_probes(self):
         cut = time.time() - PROBE_TIMEOUT * 2
-        self.probes = dict(filter(lambda x: x[1] > cut, self.probes.items()))
+        while self.probes:
+            if next(iter(self.probes.values())) > cut:
+                break
+            self.probes.popitem(last=False)
 
-    def add_header_elements(self, header, extra):
+    def header_elements(self, extra, template=False):
         action_str = extra
         if action_str == WSD_GET:
-            reply_to = ElementTree.SubElement(header, 'wsa:ReplyTo')
-            addr = ElementTree.SubElement(reply_to, 'wsa:Address')
-            addr.text = WSA_ANON
+            return ('<wsa:ReplyTo><wsa:Address>{0}</wsa:Address></wsa:ReplyTo>'
+                    '<wsa:From><wsa:Address>{1}</wsa:Address></wsa:From>').format(
+                        xml_escape(WSA_ANON), xml_escape(args.uuid.urn)).encode('utf-8')
 
-            wsa_from = ElementTree.SubElement(header, 'wsa:From')
-            addr = ElementTree.SubElement(wsa_from, 'wsa:Address')
-            addr.text = args.uuid.urn
+        return b''
 
 
 class WSDHost(WSDUDPMessageHandler):
@@ -747,6 +1529,28 @@ class WSDHost(WSDUDPMessageHandler):
         self.handlers[WSD_PROBE] = self.handle_probe
         self.handlers[WSD_RESOLVE] = self.handle_resolve
 
+        # WS-Discovery, Section 4.1, Hello message
+        hello = ElementTree.Element(ns_tag('wsd:Hello'))
+        self.add_endpoint_reference(hello)
+        # THINK: Microsoft does not send the transport address here due
+        # to privacy reasons. Could make this optional.
+        self.add_xaddr(hello, self.mch.transport_address)
+        self.add_metadata_version(hello)
+        self.hello_template = self.build_message_template(WSA_DISCOVERY, WSD_HELLO, hello)
+
+        # WS-Discovery, Section 4.2, Bye message
+        bye = ElementTree.Element(ns_tag('wsd:Bye'))
+        self.add_endpoint_reference(bye)
+        self.bye_template = self.build_message_template(WSA_DISCOVERY, WSD_BYE, bye)
+
+        # the bodies of replies to probes and resolves never change
+        values = {
+            'endpoint': xml_escape(args.uuid.urn),
+            'types': xml_escape(WSD_TYPE_DEVICE_COMPUTER),
+            'xaddrs': xml_escape('http://{0}:{1}/{2}'.format(self.mch.transport_address, WSD_HTTP_PORT, args.uuid))}
+        self.probe_match_body = (PROBE_MATCH_TEMPLATE % values).encode('utf-8')
+        self.resolve_match_body = (RESOLVE_MATCH_TEMPLATE % values).encode('utf-8')
+
         self.send_hello()
 
     def cleanup(self):
@@ -764,37 +1568,27 @@ class WSDHost(WSDUDPMessageHandler):
 
     def send_hello(self):
         """WS-Discovery, Section 4.1, Hello message"""
-        hello = ElementTree.Element('wsd:Hello')
-        self.add_endpoint_reference(hello)
-        # THINK: Microsoft does not send the transport address here due
-        # to privacy reasons. Could make this optional.
-        self.add_xaddr(hello, self.mch.transport_address)
-        self.add_metadata_version(hello)
-
-        msg = self.build_message(WSA_DISCOVERY, WSD_HELLO, None, hello)
+        msg, _ = self.fill_message_template(self.hello_template)
         self.enqueue_datagram(msg, msg_type='Hello')
 
     def send_bye(self):
         """WS-Discovery, Section 4.2, Bye message"""
-        bye = ElementTree.Element('wsd:Bye')
-        self.add_endpoint_reference(bye)
-
-        msg = self.build_message(WSA_DISCOVERY, WSD_BYE, None, bye)
-        self.enqueue_datagram(msg, msg_type='Bye')
+        msg, _ = self.fill_message_template(self.bye_template)
+        self.enqueue_datagram(msg, msg_type='Bye', burst=True)
 
     def handle_probe(self, header, body):
-        probe = body.find('./wsd:Probe', namespaces)
+        probe = select_first(XP_PROBE, body)
         if probe is None:
             return None
 
-        scopes = probe.find('./wsd:Scopes', namespaces)
+        scopes = select_first(XP_PROBE_SCOPES, probe)
 
-        if scopes:
+        if scopes is not None and len(scopes):
             # THINK: send fault message (see p. 21 in WSD)
             logger.debug('scopes ({}) unsupported but probed'.format(scopes))
             return None
 
-        types_elem = probe.find('./wsd:Types', namespaces)
+        types_elem = select_first(XP_PROBE_TYPES, probe)
         if types_elem is None:
             logger.debug('Probe message lacks wsd:Types element. Ignored.')
             return None
@@ -804,20 +1598,14 @@ class WSDHost(WSDUDPMessageHandler):
             logger.debug('unknown discovery type ({}) for probe'.format(types))
             return None
 
-        matches = ElementTree.Element('wsd:ProbeMatches')
-        match = ElementTree.SubElement(matches, 'wsd:ProbeMatch')
-        self.add_endpoint_reference(match)
-        self.add_types(match)
-        self.add_metadata_version(match)
-
-        return matches, WSD_PROBE_MATCH
+        return self.probe_match_body, WSD_PROBE_MATCH
 
     def handle_resolve(self, header, body):
-        resolve = body.find('./wsd:Resolve', namespaces)
+        resolve = select_first(XP_RESOLVE, body)
         if resolve is None:
             return None
 
-        addr = resolve.find('./wsa:EndpointReference/wsa:Address', namespaces)
+        addr = select_first(XP_ENDPOINT_ADDRESS, resolve)
         if addr is None:
             logger.debug('invalid resolve request: missing endpoint address')
             return None
@@ -827,55 +1615,44 @@ class WSDHost(WSDUDPMessageHandler):
                 addr.text, args.uuid.urn))
             return None
 
-        matches = ElementTree.Element('wsd:ResolveMatches')
-        match = ElementTree.SubElement(matches, 'wsd:ResolveMatch')
-        self.add_endpoint_reference(match)
-        self.add_types(match)
-        self.add_xaddr(match, self.mch.transport_address)
-        self.add_metadata_version(match)
+        return self.resolve_match_body, WSD_RESOLVE_MATCH
 
-        return matches, WSD_RESOLVE_MATCH
+    def header_elements(self, extra, template=False):
+        if template:
+            message_number = TEMPLATE_MESSAGE_NUMBER
+        else:
+            message_number = str(type(self).message_number)
+            type(self).message_number += 1
 
-    def add_header_elements(self, header, extra):
-        ElementTree.SubElement(header, 'wsd:AppSequence', {
-            'InstanceId': str(wsd_instance_id),
-            'SequenceId': uuid.uuid1().urn,
-            'MessageNumber': str(type(self).message_number)})
+        return '<wsd:AppSequence InstanceId="{0}" SequenceId="{1}" MessageNumber="{2}" />'.format(
+            wsd_instance_id, wsd_sequence_id, message_number).encode('utf-8')
 
+    def fill_message_template(self, template):
+        msg, msg_id = super().fill_message_template(template)
+        msg = msg.replace(TEMPLATE_MESSAGE_NUMBER.encode(), str(type(self).message_number).encode())
         type(self).message_number += 1
 
+        return msg, msg_id
+
 
 class WSDHttpMessageHandler(WSDMessageHandler):
 
+    # the metadata depends on the arguments only, so it is serialized once
+    # and shared by the handlers of all HTTP servers
+    metadata = None
+
     def __init__(self):
         super().__init__()
 
         self.handlers[WSD_GET] = self.handle_get
 
+        if WSDHttpMessageHandler.metadata is None:
+            WSDHttpMessageHandler.metadata = self.build_metadata()
+
     def handle_get(self, header, body):
-        # see https://msdn.microsoft.com/en-us/library/hh441784.aspx for an
-        # example. Some of the properties below might be made configurable
-        # in future releases.
-        metadata = ElementTree.Element('wsx:Metadata')
-        section = ElementTree.SubElement(metadata, 'wsx:MetadataSection', {'Dialect': WSDP_URI + '/ThisDevice'})
-        device = ElementTree.SubElement(section, 'wsdp:ThisDevice')
-        ElementTree.SubElement(device, 'wsdp:FriendlyName').text = ('WSD Device {0}'.format(args.hostname))
-        ElementTree.SubElement(device, 'wsdp:FirmwareVersion').text = '1.0'
-        ElementTree.SubElement(device, 'wsdp:SerialNumber').text = '1'
-
-        section = ElementTree.SubElement(metadata, 'wsx:MetadataSection', {'Dialect': WSDP_URI + '/ThisModel'})
-        model = ElementTree.SubElement(section, 'wsdp:ThisModel')
-        ElementTree.SubElement(model, 'wsdp:Manufacturer').text = 'wsdd'
-        ElementTree.SubElement(model, 'wsdp:ModelName').text = 'wsdd'
-        ElementTree.SubElement(model, 'pnpx:DeviceCategory').text = 'Computers'
-
-        section = ElementTree.SubElement(metadata, 'wsx:MetadataSection', {'Dialect': WSDP_URI + '/Relationship'})
-        rel = ElementTree.SubElement(section, 'wsdp:Relationship', {'Type': WSDP_URI + '/host'})
-        host = ElementTree.SubElement(rel, 'wsdp:Host')
-        self.add_endpoint_reference(host)
-        ElementTree.SubElement(host, 'wsdp:Types').text = PUB_COMPUTER
-        ElementTree.SubElement(host, 'wsdp:ServiceId').text = args.uuid.urn
+        return WSDHttpMessageHandler.metadata, WSD_GET_RESPONSE
 
+    def build_metadata(self):
         fmt = '{0}/Domain:{1}' if args.domain else '{0}/Workgroup:{1}'
         value = args.domain if args.domain else args.workgroup.upper()
         if args.domain:
@@ -883,9 +1660,10 @@ class WSDHttpMessageHandler(WSDMessageHandler):
         else:
             dh = args.hostname if args.preserve_case else args.hostname.upper()
 
-        ElementTree.SubElement(host, PUB_COMPUTER).text = fmt.format(dh, value)
-
-        return metadata, WSD_GET_RESPONSE
+        return (GET_RESPONSE_TEMPLATE % {
+            'hostname': xml_escape(args.hostname),
+            'endpoint': xml_escape(args.uuid.urn),
+            'computer': xml_escape(fmt.format(dh, value))}).encode('utf-8')
 
 
 class WSDHttpServer(http.server.HTTPServer):
@@ -900,6 +1678,8 @@ class WSDHttpServer(http.server.HTTPServer):
         self.mch = mch
         self.aio_loop = aio_loop
         self.wsd_handler = WSDHttpMessageHandler()
+        # the only path requests are accepted for
+        self.wsd_path = '/' + str(args.uuid)
         self.registered = False
 
         super().__init__(mch.listen_address, RequestHandlerClass)
@@ -928,14 +1708,28 @@ class WSDHttpRequestHandler(http.server.BaseHTTPRequestHandler):
         logger.info("{} - - ".format(self.address_string()) + fmt % args)
 
     def do_POST(self):
-        if self.path != '/' + str(args.uuid):
+        if self.path != self.server.wsd_path:
             self.send_error(http.HTTPStatus.NOT_FOUND)
+            return
 
         ct = self.headers['Content-Type']
         if ct is None or not ct.startswith(MIME_TYPE_SOAP_XML):
             self.send_error(http.HTTPStatus.BAD_REQUEST, 'Invalid Content-Type')
+            return
+
+        cl = self.headers['Content-Length']
+        if cl is None:
+            self.send_error(http.HTTPStatus.LENGTH_REQUIRED)
+            return
+
+        try:
+            content_length = int(cl)
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            self.send_error(http.HTTPStatus.BAD_REQUEST, 'Invalid Content-Length')
+            return
 
-        content_length = int(self.headers['Content-Length'])
         body = self.rfile.read(content_length)
 
         response = self.server.wsd_handler.handle_message(body, None, None)
@@ -1002,7 +1796,7 @@ class ApiServer:
             logger.debug('clearing list of known devices')
             WSDDiscoveredDevice.instances.clear()
         elif command == 'list' and args.discovery:
-            write_stream.write(bytes(self.get_list_reply(), 'utf-8'))
+            write_stream.write(self.get_list_reply())
         elif command == 'quit':
             write_stream.close()
         elif command == 'start':
@@ -1013,24 +1807,21 @@ class ApiServer:
             logger.debug('could not handle API request: {}'.format(line))
 
     def get_clients_by_interface(self, interface):
-        return [c for c in WSDClient.instances if c.mch.interface.name == interface or not interface]
+        if not interface:
+            return list(WSDClient.instances)
+
+        # resolve the name with the few interfaces instead of all clients
+        return [c for intf, clients in WSDClient.by_interface.items() if intf.name == interface for c in clients]
 
     def get_list_reply(self):
-        retval = ''
+        lines = []
         for dev_uuid, dev in WSDDiscoveredDevice.instances.items():
-            addrs_str = []
-            for mci, addrs in dev.addresses.items():
-                addrs_str.append(', '.join(['{}%{}'.format(a, mci.interface.name) for a in addrs]))
-
-            retval = retval + '{}\t{}\t{}\t{}\t{}\n'.format(
-                dev_uuid,
-                dev.display_name,
-                dev.props['BelongsTo'] if 'BelongsTo' in dev.props else '',
-                datetime.datetime.fromtimestamp(dev.last_seen).isoformat('T', 'seconds'),
-                ','.join(addrs_str))
-
-        retval += '.\n'
-        return retval
+            lines.append(dev_uuid.encode('utf-8'))
+            lines.append(b'\t')
+            lines.append(dev.get_list_row())
+
+        lines.append(b'.\n')
+        return b''.join(lines)
 
     async def cleanup(self):
         # ensure the server is not created after we have teared down
@@ -1131,10 +1922,12 @@ class NetworkAddressMonitor(metaclass=MetaEnumAfterInit):
         if (addr_family == socket.AF_INET6) and (addr[0:2] != b'\xfe\x80'):
             return False
 
-        addr_str = socket.inet_ntop(addr_family, addr)
-
-        if (args.interface) and (interface.name not in args.interface) and (addr_str not in args.interface):
-            return False
+        # only convert the address if it has to be matched against the given
+        # interfaces/addresses
+        if (args.interface) and (interface.name not in args.interface):
+            addr_str = socket.inet_ntop(addr_family, addr)
+            if addr_str not in args.interface:
+                return False
 
         return True
 
@@ -1225,13 +2018,12 @@ class NetworkAddressMonitor(metaclass=MetaEnumAfterInit):
             # Wait here for all pending tasks so that the main loop can be finished on termination.
             self.aio_loop.run_until_complete(asyncio.gather(*self.teardown_tasks))
         else:
-            for t in self.teardown_tasks:
-                t.add_done_callback(self.mch_teardown)
-
-    def mch_teardown(self, task):
-        if any([not t.done() for t in self.teardown_tasks]):
-            return
+            # clean up the multicast handlers once all tasks are done
+            done = asyncio.gather(*self.teardown_tasks, return_exceptions=True)
+            done.add_done_callback(self.mch_teardown)
+            return done
 
+    def mch_teardown(self, future):
         self.teardown_tasks.clear()
 
         for mch in self.mchs:
@@ -1239,7 +2031,7 @@ class NetworkAddressMonitor(metaclass=MetaEnumAfterInit):
         self.mchs.clear()
 
     def cleanup(self):
-        self.teardown()
+        return self.teardown()
 
     def get_mch_by_address(self, family, address, interface):
         """
@@ -1269,12 +2061,18 @@ NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
 # self defines
 NLM_HDR_LEN = 16
 NLM_HDR_ALIGNTO = 4
+# large enough to receive a dump of many addresses with a single call
+NETLINK_RECV_LEN = 65536
+# socket buffer for netlink messages (capped by the kernel), the default is
+# exceeded by address dumps on hosts with many addresses
+NETLINK_RCVBUF_SIZE = 1024 * 1024
 
 # ifa flags
 IFA_F_DADFAILED = 0x08
 IFA_F_HOMEADDRESS = 0x10
 IFA_F_DEPRECATED = 0x20
 IFA_F_TENTATIVE = 0x40
+IFA_F_INVALID = IFA_F_DADFAILED | IFA_F_HOMEADDRESS | IFA_F_DEPRECATED | IFA_F_TENTATIVE
 
 # from if_addr.h
 IFA_ADDRESS = 1
@@ -1286,9 +2084,16 @@ IFA_MSG_LEN = 8
 RTA_ALIGNTO = 4
 RTA_LEN = 4
 
+# precompiled layouts of nlmsghdr, ifaddrmsg and rtattr
+NLM_HDR_STRUCT = struct.Struct('@IHHII')
+IFA_MSG_STRUCT = struct.Struct('@BBBBI')
+RTA_STRUCT = struct.Struct('HH')
+IFA_FLAGS_STRUCT = struct.Struct('HI')
+
 
 def align_to(x, n):
-    return ((x + n - 1) // n) * n
+    # all alignments used here are powers of two
+    return (x + n - 1) & ~(n - 1)
 
 
 class NetlinkAddressMonitor(NetworkAddressMonitor):
@@ -1311,6 +2116,7 @@ class NetlinkAddressMonitor(NetworkAddressMonitor):
 
         self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
         self.socket.bind((0, rtm_groups))
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, NETLINK_RCVBUF_SIZE)
         self.aio_loop.add_reader(self.socket.fileno(), self.handle_request)
 
     def do_enumerate(self):
@@ -1324,12 +2130,23 @@ class NetlinkAddressMonitor(NetworkAddressMonitor):
     def handle_request(self):
         super().handle_request()
 
-        buf, src = self.socket.recvfrom(4096)
-        logger.debug('netlink message with {} bytes'.format(len(buf)))
+        # the kernel sends many messages back-to-back, e.g. on enumeration,
+        # handle all of them at once
+        while True:
+            try:
+                buf = self.socket.recv(NETLINK_RECV_LEN, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
 
+            logger.debug('netlink message with {} bytes'.format(len(buf)))
+            self.parse_netlink_response(buf)
+
+    def parse_netlink_response(self, buf):
+        # slicing the view does not copy the addresses out of the buffer
+        buf = memoryview(buf)
         offset = 0
         while offset < len(buf):
-            h_len, h_type, _, _, _ = struct.unpack_from('@IHHII', buf, offset)
+            h_len, h_type, _, _, _ = NLM_HDR_STRUCT.unpack_from(buf, offset)
             offset += NLM_HDR_LEN
 
             msg_len = h_len - NLM_HDR_LEN
@@ -1342,9 +2159,8 @@ class NetlinkAddressMonitor(NetworkAddressMonitor):
                 continue
 
             # decode ifaddrmsg as in rtnetlink.h
-            ifa_family, _, ifa_flags, ifa_scope, ifa_idx = struct.unpack_from('@BBBBI', buf, offset)
-            if ((ifa_flags & IFA_F_DADFAILED) or (ifa_flags & IFA_F_HOMEADDRESS)
-                    or (ifa_flags & IFA_F_DEPRECATED) or (ifa_flags & IFA_F_TENTATIVE)):
+            ifa_family, _, ifa_flags, ifa_scope, ifa_idx = IFA_MSG_STRUCT.unpack_from(buf, offset)
+            if ifa_flags & IFA_F_INVALID:
                 logger.debug('ignore address with invalid state {}'.format(hex(ifa_flags)))
                 offset += align_to(msg_len, NLM_HDR_ALIGNTO)
                 continue
@@ -1354,7 +2170,7 @@ class NetlinkAddressMonitor(NetworkAddressMonitor):
             addr = None
             i = offset + IFA_MSG_LEN
             while i - offset < msg_len:
-                attr_len, attr_type = struct.unpack_from('HH', buf, i)
+                attr_len, attr_type = RTA_STRUCT.unpack_from(buf, i)
                 logger.debug('rt_attr {} {}'.format(attr_len, attr_type))
 
                 if attr_len < RTA_LEN:
@@ -1369,7 +2185,7 @@ class NetlinkAddressMonitor(NetworkAddressMonitor):
                 elif attr_type == IFA_ADDRESS and ifa_family == socket.AF_INET6:
                     addr = buf[i + 4:i + 4 + 16]
                 elif attr_type == IFA_FLAGS:
-                    _, ifa_flags = struct.unpack_from('HI', buf, i)
+                    _, ifa_flags = IFA_FLAGS_STRUCT.unpack_from(buf, i)
                 i += align_to(attr_len, RTA_ALIGNTO)
 
             if addr is None:
@@ -1405,7 +2221,7 @@ class NetlinkAddressMonitor(NetworkAddressMonitor):
     def cleanup(self):
         self.aio_loop.remove_reader(self.socket.fileno())
         self.socket.close()
-        super().cleanup()
+        return super().cleanup()
 
 
 # from sys/net/route.h
@@ -1426,6 +2242,14 @@ IN6_IFF_NOTREADY = IN6_IFF_TENTATIVE | IN6_IFF_DUPLICATED
 
 SA_ALIGNTO = ctypes.sizeof(ctypes.c_long)
 
+# precompiled layouts of the rt_msghdr/if_msghdr prefix and sockaddr(_dl)
+RTM_HDR_STRUCT = struct.Struct('@HBB')
+RTM_MASK_FLAGS_STRUCT = struct.Struct('ii')
+SA_HDR_STRUCT = struct.Struct('@BB')
+SA_LINK_STRUCT = struct.Struct('@HBB')
+# offset and length of the address in sockaddr_in(6)
+SA_ADDR_LAYOUT = {socket.AF_INET: (4, 4), socket.AF_INET6: (8, 16)}
+
 
 class RouteSocketAddressMonitor(NetworkAddressMonitor):
     """
@@ -1473,14 +2297,16 @@ class RouteSocketAddressMonitor(NetworkAddressMonitor):
         self.parse_route_socket_response(self.socket.recv(4096), False)
 
     def parse_route_socket_response(self, buf, keep_intf):
+        # slicing the view does not copy the addresses out of the buffer
+        buf = memoryview(buf)
         offset = 0
 
         intf = None
         intf_flags = 0
         while offset < len(buf):
-            rtm_len, _, rtm_type = struct.unpack_from('@HBB', buf, offset)
+            rtm_len, _, rtm_type = RTM_HDR_STRUCT.unpack_from(buf, offset)
             # addr_mask has same offset in if_msghdr and ifs_msghdr
-            addr_mask, flags = struct.unpack_from('ii', buf, offset + 4)
+            addr_mask, flags = RTM_MASK_FLAGS_STRUCT.unpack_from(buf, offset + 4)
 
             msg_types = [self.RTM_NEWADDR, self.RTM_DELADDR, self.RTM_IFINFO]
             if rtm_type not in msg_types:
@@ -1513,18 +2339,17 @@ class RouteSocketAddressMonitor(NetworkAddressMonitor):
             while not (addr_type_idx & addr_mask) and (addr_type_idx <= addr_mask):
                 addr_type_idx = addr_type_idx << 1
 
-            sa_len, sa_fam = struct.unpack_from('@BB', buf, offset)
-            if sa_fam in [socket.AF_INET, socket.AF_INET6] and addr_type_idx == RTA_IFA:
+            sa_len, sa_fam = SA_HDR_STRUCT.unpack_from(buf, offset)
+            if sa_fam in SA_ADDR_LAYOUT and addr_type_idx == RTA_IFA:
                 addr_family = sa_fam
-                addr_offset = 4 if sa_fam == socket.AF_INET else 8
-                addr_length = 16 if sa_fam == socket.AF_INET6 else 4
+                addr_offset, addr_length = SA_ADDR_LAYOUT[sa_fam]
                 addr_start = offset + addr_offset
                 addr = buf[addr_start:addr_start + addr_length]
             elif sa_fam == socket.AF_LINK:
-                idx, _, name_len = struct.unpack_from('@HBB', buf, offset + 2)
+                idx, _, name_len = SA_LINK_STRUCT.unpack_from(buf, offset + 2)
                 if idx > 0:
                     off_name = offset + 8
-                    if_name = (buf[off_name:off_name + name_len]).decode()
+                    if_name = str(buf[off_name:off_name + name_len], 'utf-8')
                     intf = self.add_interface(if_name, idx, idx)
 
             offset += align_to(sa_len, SA_ALIGNTO) if sa_len > 0 else SA_ALIGNTO
@@ -1552,13 +2377,15 @@ class RouteSocketAddressMonitor(NetworkAddressMonitor):
     def cleanup(self):
         self.aio_loop.remove_reader(self.socket.fileno())
         self.socket.close()
-        super().cleanup()
+        return super().cleanup()
 
 
-def sigterm_handler():
-    logger.info('received termination/interrupt signal, tearing down')
-    # implictely raise SystemExit to cleanup properly
-    sys.exit(0)
+# address monitor implementations by operating system
+ADDRESS_MONITORS = {
+    'linux': NetlinkAddressMonitor,
+    'android': NetlinkAddressMonitor,
+    'freebsd': RouteSocketAddressMonitor,
+}
 
 
 def parse_args():
@@ -1654,7 +2481,6 @@ def parse_args():
         log_level = logging.INFO
     elif args.verbose > 1:
         log_level = logging.DEBUG
-        asyncio.get_event_loop().set_debug(True)
         logging.getLogger("asyncio").setLevel(logging.DEBUG)
     else:
         log_level = logging.WARNING
@@ -1670,6 +2496,9 @@ def parse_args():
     if not args.interface:
         logger.warning('no interface given, using all interfaces')
 
+    # interfaces are looked up for every new address
+    args.interface = frozenset(args.interface)
+
     if not args.uuid:
         #args.uuid = uuid.uuid5(uuid.NAMESPACE_DNS, socket.gethostname())
         import configparser
@@ -1677,33 +2506,42 @@ def parse_args():
         configFile.read("/media/usb/pilaroid.ini")
         args.uuid = uuid.uuid5(uuid.NAMESPACE_DNS, configFile["APPLICATION"]["name"])
         args.hostname = configFile["APPLICATION"]["name"]
-        logger.info('using pre-defined UUID {0}'.format(str(args.uuid)))
+        logger.info('using pre-defined UUID %s', args.uuid)
     else:
         args.uuid = uuid.UUID(args.uuid)
-        logger.info('user-supplied device UUID is {0}'.format(str(args.uuid)))
-
-    for prefix, uri in namespaces.items():
-        ElementTree.register_namespace(prefix, uri)
+        logger.info('user-supplied device UUID is %s', args.uuid)
 
 
 def chroot(root):
     """
     Chroot into a separate directory to isolate ourself for increased security.
     """
-    # preload for socket.gethostbyaddr()
-    import encodings.idna
-
     try:
         os.chroot(root)
         os.chdir('/')
-        logger.info('chrooted successfully to {}'.format(root))
-    except Exception as e:
-        logger.error('could not chroot to {}: {}'.format(root, e))
+        logger.info('chrooted successfully to %s', root)
+    except OSError as e:
+        logger.error('could not chroot to %s: %s', root, e)
         return False
 
     return True
 
 
+# NSS lookups may be expensive (e.g. LDAP), so their results are cached. The
+# cache is not invalidated, changes in the user database require a restart.
+@functools.lru_cache(maxsize=32)
+def lookup_uid(user):
+    # only needed when switching the user, so import on demand
+    import pwd
+    return pwd.getpwnam(user).pw_uid
+
+
+@functools.lru_cache(maxsize=32)
+def lookup_gid(group):
+    import grp
+    return grp.getgrnam(group).gr_gid
+
+
 def get_ids_from_userspec(user_spec):
     uid = None
     gid = None
@@ -1711,12 +2549,12 @@ def get_ids_from_userspec(user_spec):
         user, _, group = user_spec.partition(':')
 
         if user:
-            uid = pwd.getpwnam(user).pw_uid
+            uid = lookup_uid(user)
 
         if group:
-            gid = grp.getgrnam(group).gr_gid
-    except Exception as e:
-        logger.error('could not get uid/gid for {}: {}'.format(user_spec, e))
+            gid = lookup_gid(group)
+    except (KeyError, OSError) as e:
+        logger.error('could not get uid/gid for %s: %s', user_spec, e)
         return False
 
     return (uid, gid)
@@ -1724,24 +2562,50 @@ def get_ids_from_userspec(user_spec):
 
 def drop_privileges(uid, gid):
     try:
+        # set real, effective and saved IDs at once where supported
         if gid is not None:
-            os.setgid(gid)
-            os.setegid(gid)
-            logger.debug('switched uid to {}'.format(uid))
+            if hasattr(os, 'setresgid'):
+                os.setresgid(gid, gid, gid)
+            else:
+                # with privileges, setgid(2) sets the real, effective and
+                # saved gid
+                os.setgid(gid)
+            logger.debug('switched gid to %s', gid)
 
         if uid is not None:
-            os.setuid(uid)
-            os.seteuid(uid)
-            logger.debug('switched gid to {}'.format(gid))
+            if hasattr(os, 'setresuid'):
+                os.setresuid(uid, uid, uid)
+            else:
+                # see setuid(2), same as above
+                os.setuid(uid)
+            logger.debug('switched uid to %s', uid)
 
-        logger.info('running as {} ({}:{})'.format(args.user, uid, gid))
-    except Exception as e:
-        logger.error('dropping privileges failed: {}'.format(e))
+        logger.info('running as %s (%s:%s)', args.user, uid, gid)
+    except OSError as e:
+        logger.error('dropping privileges failed: %s', e)
         return False
 
     return True
 
 
+async def shutdown(address_monitor, api_server):
+    """
+    Tear down the address monitor and close the API server concurrently.
+    """
+    aws = []
+    teardown = address_monitor.cleanup()
+    if teardown is not None:
+        aws.append(teardown)
+    if api_server is not None:
+        aws.append(api_server.cleanup())
+
+    # always wait for the teardown to complete, even if closing the API
+    # server fails
+    for result in await asyncio.gather(*aws, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error('error while shutting down', exc_info=result)
+
+
 def main():
     parse_args()
 
@@ -1749,13 +2613,18 @@ def main():
         logger.error('Listening to no IP address family.')
         return 4
 
-    aio_loop = asyncio.get_event_loop()
-    if platform.system() == 'Linux':
-        nm = NetlinkAddressMonitor(aio_loop)
-    elif platform.system() == 'FreeBSD':
-        nm = RouteSocketAddressMonitor(aio_loop)
-    else:
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # uvloop's policy does not create a loop on demand
+    aio_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(aio_loop)
+    if args.verbose > 1:
+        aio_loop.set_debug(True)
+
+    if PLATFORM not in ADDRESS_MONITORS:
         raise NotImplementedError('unsupported OS')
+    nm = ADDRESS_MONITORS[PLATFORM](aio_loop)
 
     api_server = None
     if args.listen:
@@ -1775,23 +2644,28 @@ def main():
         if not drop_privileges(ids[0], ids[1]):
             return 3
 
-    if args.chroot and (os.getuid() == 0 or os.getgid() == 0):
+    if args.chroot and (os.geteuid() == 0 or os.getegid() == 0):
         logger.warning('chrooted but running as root, consider -u option')
 
-    # main loop, serve requests coming from any outbound socket
-    aio_loop.add_signal_handler(signal.SIGINT, sigterm_handler)
-    aio_loop.add_signal_handler(signal.SIGTERM, sigterm_handler)
+    # main loop, serve requests coming from any outbound socket until a
+    # termination/interrupt signal arrives
+    stop_event = asyncio.Event()
+
+    def stop_on_signal(signum, frame):
+        # plain signal handler, it only has to wake up the loop
+        aio_loop.call_soon_threadsafe(stop_event.set)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, stop_on_signal)
     try:
-        aio_loop.run_forever()
-    except (SystemExit, KeyboardInterrupt):
-        logger.info('shutting down gracefully...')
-        if api_server is not None:
-            aio_loop.run_until_complete(api_server.cleanup())
-
-        nm.cleanup()
-        aio_loop.stop()
+        aio_loop.run_until_complete(stop_event.wait())
     except Exception:
         logger.exception('error in main loop')
+    else:
+        logger.info('received termination/interrupt signal, shutting down gracefully...')
+        aio_loop.run_until_complete(shutdown(nm, api_server))
+        aio_loop.run_until_complete(stop_sender())
+        aio_loop.run_until_complete(close_http_session())
 
     logger.info('Done.')
     return 0